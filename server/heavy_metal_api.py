@@ -1,15 +1,43 @@
-from fastapi import FastAPI
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-import numpy as np
-from scipy.stats import gamma
-from typing import List, Dict
-from pydantic import BaseModel
-from fitter import Fitter
-from scipy.stats import truncnorm
-from scipy.stats import gaussian_kde
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from typing import Annotated, List, Dict, Literal, Optional
+from pydantic import BaseModel, Field
+from heavy_metal_fits import FIT_FAMILY, element_columns, fit_cache
+from heavy_metal_cache import ResultCache
+from heavy_metal_core import (
+    BATCH_CHUNK_SIZE, ELEMENTS, TRAJECTORY_MAX_YEARS, compute_custom, compute_exceedance,
+    compute_max_application_rates, compute_multi_element, compute_preset, compute_sweep, compute_trajectory,
+    concentration_curve, sample_preset
+)
+from heavy_metal_encoding import COMPACT_JSON, COMPACT_NDJSON, JSON, NDJSON, encode, is_compact, is_stream, negotiate
+from heavy_metal_sensitivity import (
+    BOOTSTRAP_RESAMPLES, SOBOL_SAMPLES, compute_custom_sensitivity, compute_sensitivity
+)
+from heavy_metal_metrics import (
+    ENABLED as METRICS_ENABLED, SERVER_TIMING, end_request, record_request, render, server_timing, span,
+    start_request
+)
+from heavy_metal_workers import WORKERS, QueueFullError, worker_pool
+from heavy_metal_store import data_fingerprint, file_hash
+from heavy_metal_thresholds import THRESHOLDS_PATH, ThresholdResult, threshold_index
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fit any distributions missing from the on-disk cache before serving requests
+    fit_cache.warm(element_columns(ELEMENTS), FIT_FAMILY, workers=WORKERS)
+    worker_pool.start(preload=["heavy_metal_core"])
+    if os.getenv("HEAVY_METAL_WARM_RESULTS") == "1":
+        await warm_preset_cache()
+    yield
+    worker_pool.shutdown()
 
-app = FastAPI(title="Enhanced Rock Weathering Heavy Metal Analysis API")
+app = FastAPI(title="Enhanced Rock Weathering Heavy Metal Analysis API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,29 +47,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.get("/")
-async def root():
-    return {"status": "healthy", "message": "Heavy Metal API is running"}
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
-soil_data = pd.read_csv('data/cleaned_soil_data.csv')
-basalt_feedstock_data = pd.read_csv('data/cleaned_feedstock_data_basalt.csv')
-peridotite_feedstock_data = pd.read_csv('data/cleaned_feedstock_data_peridotite.csv')
-threshold_data = pd.read_csv('data/model_thresholds.csv')
+if METRICS_ENABLED:
+    @app.middleware("http")
+    async def timing_middleware(request: Request, call_next):
+        """Collect the spans of each request into the metrics and, optionally, a Server-Timing header"""
+        spans, token = start_request()
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            end_request(token)
+        elapsed = time.perf_counter() - start
+        
+        # Unknown paths share one label so scans cannot blow up the metric cardinality
+        endpoint = request.url.path if request.url.path in ROUTE_PATHS else "other"
+        record_request(endpoint, response.status_code, elapsed, spans)
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = server_timing(spans, elapsed)
+        return response
 
-class ThresholdEntry(BaseModel):
-    label: str
-    threshold: float
+def encoded(result, accept, media_types=(JSON, COMPACT_JSON)):
+    """Return a result as plain JSON, or in the compact curve encoding when the Accept header asks for it"""
+    media_type = negotiate(accept, media_types)
+    if media_type == JSON:
+        if not METRICS_ENABLED:
+            return result
+        # Serialize here rather than in FastAPI so the time is part of the request's spans
+        with span("serialize"):
+            return JSONResponse(jsonable_encoder(result))
+    with span("serialize"):
+        return Response(encode(result, media_type), media_type=media_type)
 
-class ThresholdResult(BaseModel):
-    Total: List[ThresholdEntry]
-    Aqua_regia: List[ThresholdEntry]
-    Other_very_strong_acid: List[ThresholdEntry]
+@app.get("/")
+async def root():
+    return {"status": "healthy", "message": "Heavy Metal API is running"}
 
 class PresetCalculationParams(BaseModel):
     element: str
     feedstock_type: str
+    seed: Optional[int] = Field(None, ge=0)
+    kde_method: Literal['binned', 'exact'] = 'binned'
+    # Optional soil baseline region: lat/lon with radius_km and/or nearest, state, land_cover
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+    radius_km: Optional[float] = Field(None, gt=0)
+    nearest: Optional[int] = Field(None, gt=0)
+    state: Optional[str] = None
+    land_cover: Optional[str] = None
+    # Adaptive sample size: draw until quantiles and exceedance fractions are within this tolerance
+    tolerance: Optional[float] = Field(None, gt=0, lt=1)
+    # How fixed-size runs draw their inputs (adaptive runs always draw randomly)
+    sampler: Literal['random', 'lhs', 'sobol'] = 'random'
+
+    def region(self):
+        """The soil baseline region as a plain dict, or None for the national dataset"""
+        region = self.model_dump(include=REGION_FIELDS, exclude_none=True)
+        return region or None
 
-class CustomCalculationParams(BaseModel):
+REGION_FIELDS = {'latitude', 'longitude', 'radius_km', 'nearest', 'state', 'land_cover'}
+
+class CustomScenarioParams(BaseModel):
     soil_conc: float
     soil_conc_sd: float
     soil_d: float
@@ -53,261 +122,385 @@ class CustomCalculationParams(BaseModel):
     application_rate: float 
     element: str
     feedstock_type: str
+    seed: Optional[int] = Field(None, ge=0)
+
+class CustomCalculationParams(CustomScenarioParams):
+    kde_method: Literal['binned', 'exact'] = 'binned'
+    tolerance: Optional[float] = Field(None, gt=0, lt=1)
+    sampler: Literal['random', 'lhs', 'sobol'] = 'random'
+
+class SensitivityOptions(BaseModel):
+    samples: int = Field(default=SOBOL_SAMPLES, ge=256, le=65536)  # Rounded up to a power of two
+    bootstrap: int = Field(default=BOOTSTRAP_RESAMPLES, ge=0, le=1000)
+    confidence: float = Field(default=0.95, gt=0, lt=1)
+
+class SensitivityParams(SensitivityOptions):
+    element: str
+    feedstock_type: str
+    application_rate: float = Field(ge=0)
+    seed: Optional[int] = Field(None, ge=0)
+
+class CustomSensitivityParams(CustomScenarioParams, SensitivityOptions):
+    pass
+
+class BatchCustomCalculationParams(BaseModel):
+    scenarios: List[CustomCalculationParams] = Field(max_length=1000)
+    stream: bool = False
+
+class ExceedanceParams(BaseModel):
+    element: str
+    feedstock_type: str
+    seed: Optional[int] = Field(None, ge=0)
+
+class MaxApplicationRateParams(BaseModel):
+    element: str
+    feedstock_type: str
+    quantile: float = Field(default=0.95, gt=0, le=1)
+    thresholds: Optional[List[float]] = None
+    seed: Optional[int] = Field(None, ge=0)
+
+class SweepParams(BaseModel):
+    element: str
+    feedstock_type: str
+    application_rates: List[Annotated[float, Field(ge=0)]] = Field(min_length=1, max_length=2000)
+    kde_rates: List[Annotated[float, Field(ge=0)]] = Field(default=[], max_length=20)
+    seed: Optional[int] = Field(None, ge=0)
+    kde_method: Literal['binned', 'exact'] = 'binned'
+
+class TrajectoryParams(BaseModel):
+    element: str
+    feedstock_type: str
+    annual_rate: float = Field(ge=0)  # t/ha applied every year
+    years: int = Field(default=30, ge=1, le=TRAJECTORY_MAX_YEARS)
+    leaching_rate: float = Field(default=0, ge=0)  # First-order loss rate constants, per year
+    uptake_rate: float = Field(default=0, ge=0)
+    seed: Optional[int] = Field(None, ge=0)
+
+class MultiElementParams(BaseModel):
+    elements: List[str] = Field(min_length=1, max_length=16)
+    feedstock_type: str
+    threshold_category: Optional[Literal['Total', 'Aqua_regia', 'Other_very_strong_acid']] = None
+    seed: Optional[int] = Field(None, ge=0)
+    kde_method: Literal['binned', 'exact'] = 'binned'
 
 class CalculationResult(BaseModel):
     distributions: Dict[str, Dict[str, List[float]]]
     concentrations: Dict[str, List[float]]
 
-def get_dist(df, element, sample_size=10000):
-    """Get distribution of metal concentrations"""
-    f = Fitter(df[element].dropna(), distributions=['gamma'])
-    f.fit()
-    
-    best_fit = f.get_best(method='sumsquare_error')
-    dist_type = list(best_fit.keys())[0]
-    
-    a = best_fit[dist_type]['a']
-    loc = best_fit[dist_type]['loc']
-    scale = best_fit[dist_type]['scale']
-    
-    rv = gamma(a, loc, scale)
-    return rv.rvs(size=sample_size)
+def get_thresh(element) -> ThresholdResult:
+    """Get threshold values for an element, categorized by extraction type"""
+    with span("thresholds"):
+        return threshold_index.get(element)
+
+@app.get("/elements")
+def get_elements(feedstock_type: str):
+    """Get list of available elements based on feedstock type"""
+    if feedstock_type not in ELEMENTS:
+        return {"error": "Invalid feedstock type. Must be either 'basalt' or 'peridotite'"}
     
+    return {"elements": ELEMENTS[feedstock_type]}
 
-def calc_feedstock_conc(feedstock_conc, soil_d, dbd, t):
-    """Calculate the concentration contribution from feedstock application"""
-    return (feedstock_conc * (t/10))/soil_d/dbd
-
-def calc_soil_conc(soil_conc):
-    """Calculate the concentration contribution from existing soil"""
-    return soil_conc
-
-def calc_element_conc(soil_d, feedstock_conc, soil_conc, dbd, t):
-    """Calculate total element concentration by combining feedstock and soil contributions"""
-    feedstock_contribution = calc_feedstock_conc(feedstock_conc, soil_d, dbd, t)
-    soil_contribution = calc_soil_conc(soil_conc)
-    return feedstock_contribution + soil_contribution
-
-def calc_soil_conc_dist(soil_conc, n=10000):
-    """Calculate distribution of soil concentrations"""
-    rng = np.random.default_rng()
-    total_conc_list = [
-        calc_soil_conc(rng.choice(soil_conc, 1)[0])
-        for _ in range(n)
-    ]
-    return total_conc_list
-
-def calc_feedstock_conc_dist(feedstock_conc, soil_d, dbd, t, n=10000):
-    """Calculate distribution of feedstock concentrations"""
-    rng = np.random.default_rng()
-    total_conc_list = [
-        calc_feedstock_conc(rng.choice(feedstock_conc, 1)[0], max(rng.choice(soil_d, 1)[0], 1), rng.choice(dbd, 1)[0], t)
-        for _ in range(n)
-    ]
-    return total_conc_list
-
-def calc_element_conc_dist(t, dbd_dist, soil_d_dist, feedstock_dist, soil_dist, n=10000):
-    """Calculate distribution of total element concentrations for given application rate"""
-    rng = np.random.default_rng()
-    total_conc_list = [
-        calc_element_conc(
-            max(rng.choice(soil_d_dist, 1)[0], 1),  # Ensure soil_d >= 1
-            rng.choice(feedstock_dist, 1)[0],
-            rng.choice(soil_dist, 1)[0],
-            rng.choice(dbd_dist, 1)[0],
-            t
-        )
-        for _ in range(n)
+def preset_fingerprint():
+    """The data files plus the thresholds CSV, which adaptive preset runs converge against"""
+    return data_fingerprint() + (("thresholds", file_hash(THRESHOLDS_PATH)),)
+
+preset_cache = ResultCache(fingerprint=preset_fingerprint)
+
+async def warm_preset_cache():
+    """Calculate and cache the unseeded preset result for every element/feedstock pair"""
+    warmed = 0
+    for feedstock_type, elements in ELEMENTS.items():
+        for element_short in elements:
+            try:
+                result = await worker_pool.run(compute_preset, element_short, feedstock_type)
+            except QueueFullError:
+                raise
+            except Exception:
+                # A missing fit or data column should not stop the other pairs warming
+                continue
+            if "error" in result:
+                continue
+            preset_cache.set(preset_key(PresetCalculationParams(element=element_short, feedstock_type=feedstock_type)), result)
+            warmed += 1
+    return warmed
+
+def threshold_values(element):
+    """All threshold values for an element, to check exceedance convergence against"""
+    return [entry.threshold for _, entry in get_thresh(element).entries()]
+
+def threshold_records(element):
+    """All thresholds for an element as {"label", "threshold", "category"} records, for the response"""
+    return [
+        {"label": entry.label, "threshold": entry.threshold, "category": category}
+        for category, entry in get_thresh(element).entries()
     ]
-    return total_conc_list
-
-def get_dbd_dist():
-    """Get bulk density distribution"""
-    n= 1000
-    mean = 1250
-    std_dev = 250
-    a = 800  # Lower bound
-    b = 1700  # Upper bound
-    
-    truncated_normal = truncnorm(
-        (a - mean) / std_dev,
-        (b - mean) / std_dev,
-        loc=mean,
-        scale=std_dev
-    )
-    
-    return truncated_normal.rvs(size=n)
-    
 
-def get_thresh(element) -> ThresholdResult:
-    """Get threshold values for an element, categorized by extraction type"""
-    # Clean threshold values by removing commas
-    threshold_data['Threshold Level (mg/kg)'] = threshold_data['Threshold Level (mg/kg)'].apply(
-        lambda x: x.replace(',', '') if isinstance(x, str) and ',' in x else x
-    )
+def preset_key(params):
+    region = params.region()
+    return (params.element, params.feedstock_type, params.seed, params.kde_method,
+            tuple(sorted(region.items())) if region else None, params.tolerance, params.sampler)
+
+def preset_args(params):
+    """Positional arguments of compute_preset/sample_preset for a request"""
+    thresholds = threshold_values(params.element) if params.tolerance else ()
+    return (params.element, params.feedstock_type, params.seed, params.kde_method, params.region(),
+            params.tolerance, thresholds, params.sampler)
+
+async def iter_preset_parts(params):
+    """Yield a preset result in parts: the result without concentrations first, then one part per application rate
     
-    # Filter for the specific element
-    element_data = threshold_data[threshold_data['Metal'] == element]
+    The first worker call runs before the first part is yielded, so a full queue
+    surfaces as a 503 before any response is started.
+    """
+    key = preset_key(params)
+    cached = preset_cache.get(key)
+    if cached is not None:
+        concentrations = cached["concentrations"]
+        head = {name: value for name, value in cached.items() if name != "concentrations"}
+        yield {**head, "application_rates": list(concentrations)}
+        for rate, curve in concentrations.items():
+            yield {"rate": rate, **curve}
+        return
     
-    # Initialize the result dictionary
-    thresholds = {
-        "Total": [],
-        "Aqua_regia": [],
-        "Other_very_strong_acid": []
-    }
+    head, conc_dists = await worker_pool.run(sample_preset, *preset_args(params))
+    yield head
+    if conc_dists is None:
+        return
     
-    # Process each row and categorize by extraction type
-    for _, row in element_data.iterrows():
-        extraction_type = row['Total, Aqua regia, extractable, or other (specify)']
-        if pd.isna(extraction_type):
-            continue
-            
-        # Clean and convert threshold value
+    concentrations = {}
+    for rate, conc_dist in zip(head["application_rates"], conc_dists):
         try:
-            threshold_value = float(row['Threshold Level (mg/kg)'])
-        except (ValueError, TypeError):
-            continue
-            
-        threshold_entry = ThresholdEntry(
-            label=row['Label'],
-            threshold=threshold_value
-        )
-        
-        # Categorize based on extraction type
-        if "total" in extraction_type.lower():
-            thresholds["Total"].append(threshold_entry)
-        elif "aqua regia" in extraction_type.lower():
-            thresholds["Aqua_regia"].append(threshold_entry)
-        else:
-            thresholds["Other_very_strong_acid"].append(threshold_entry)
+            curve = await worker_pool.run(concentration_curve, conc_dist, params.kde_method)
+        except QueueFullError as e:
+            # The response has already started, so report the failure in-stream
+            yield {"error": str(e)}
+            return
+        concentrations[rate] = curve
+        yield {"rate": rate, **curve}
     
-    return ThresholdResult(**thresholds)
+    result = {name: value for name, value in head.items() if name != "application_rates"}
+    preset_cache.set(key, {**result, "concentrations": concentrations})
 
-def calculate_normalized_kde(data, num_points=200):
-    """Calculate KDE for the given data and normalize to percentages"""
-    # Remove any negative values as they don't make sense for concentrations
-    data = data[data >= 0]
-    
-    # Calculate the KDE
-    kde = gaussian_kde(data)
+@app.post("/calculate-preset")
+async def calculate_preset(params: PresetCalculationParams, accept: Optional[str] = Header(default=None)):
+    """Calculate metal concentrations using preset parameters, served from the result cache when possible
     
-    # Generate points to evaluate the KDE
-    x_range = np.linspace(min(data), max(data), num_points)
-    y_values = kde(x_range)
+    Accept: application/x-ndjson streams the feedstock/soil distributions first and
+    then each application rate's curve as soon as it is computed; see
+    heavy_metal_encoding for the compact float32 encodings.
+    """
+    media_type = negotiate(accept)
+    if is_stream(media_type):
+        parts = iter_preset_parts(params)
+        first = await parts.__anext__()
+        
+        async def lines():
+            yield encode(first, media_type)
+            async for part in parts:
+                yield encode(part, media_type)
+        return StreamingResponse(lines(), media_type=media_type)
     
-    # Normalize y-values to percentages (0-100)
-    y_values = (y_values / np.max(y_values)) * 100
+    key = preset_key(params)
+    result = preset_cache.get(key)
+    if result is None:
+        result = await worker_pool.run(compute_preset, *preset_args(params))
+        if "error" not in result:
+            preset_cache.set(key, result)
+    return encoded(result, accept)
+
+@app.post("/admin/warm-cache")
+async def warm_cache(x_admin_token: Optional[str] = Header(default=None)):
+    """Pre-compute the preset results for all element/feedstock pairs"""
+    admin_token = os.getenv("HEAVY_METAL_ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled: HEAVY_METAL_ADMIN_TOKEN is not set")
+    if not secrets.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
     
-    return x_range.tolist(), y_values.tolist()
+    start = time.perf_counter()
+    warmed = await warm_preset_cache()
+    return {"warmed": warmed, "cached": len(preset_cache), "seconds": time.perf_counter() - start}
 
-@app.get("/elements")
-def get_elements(feedstock_type: str):
-    """Get list of available elements based on feedstock type"""
-    if feedstock_type == 'basalt':
-        elements = ['Ag', 'As', 'Be', 'Cd', 'Co', 'Cr', 'Cu', 'Hg', 'Mn', 'Ni', 'Pb', 'Sb', 'Se', 'V', 'Zn']
-    elif feedstock_type == 'peridotite':
-        elements = ['Ag', 'As', 'Ba', 'Be', 'Cd', 'Co', 'Cr', 'Cu', 'Mn', 'Ni', 'Pb', 'Sb', 'Se', 'V', 'Zn']
-    else:
+@app.post("/calculate-multi-element")
+async def calculate_multi_element(params: MultiElementParams, accept: Optional[str] = Header(default=None)):
+    """Simulate several elements in one pass, preserving their correlation in the feedstock and soil data
+    
+    Thresholds are limited to threshold_category when it is given.
+    """
+    if params.feedstock_type not in ELEMENTS:
         return {"error": "Invalid feedstock type. Must be either 'basalt' or 'peridotite'"}
+    unavailable = [element for element in params.elements if element not in ELEMENTS[params.feedstock_type]]
+    if unavailable:
+        return {"error": f"Elements not available for {params.feedstock_type}: {', '.join(unavailable)}"}
     
-    return {"elements": elements}
+    elements = list(dict.fromkeys(params.elements))
+    thresholds = {
+        element: [
+            entry.threshold for category, entry in thresholds.entries()
+            if params.threshold_category in (None, category)
+        ]
+        for element, thresholds in threshold_index.get_many(elements).items()
+    }
+    result = await worker_pool.run(
+        compute_multi_element, elements, params.feedstock_type, thresholds, params.seed, params.kde_method
+    )
+    return encoded(result, accept)
 
-@app.post("/calculate-preset")
-def calculate_preset(params: PresetCalculationParams):
-    """Calculate metal concentrations using preset parameters"""
-    element_short = params.element
-    element = f"{element_short} (mg/kg)"
-    feedstock_type = params.feedstock_type
-    
-    if feedstock_type == 'basalt':
-        feedstock_data = basalt_feedstock_data
-    elif feedstock_type == 'peridotite':
-        feedstock_data = peridotite_feedstock_data
+@app.post("/calculate-sweep")
+async def calculate_sweep(params: SweepParams, accept: Optional[str] = Header(default=None)):
+    """Calculate p5/p50/p95 concentration bands over a dense grid of application rates from one sample set"""
+    result = await worker_pool.run(
+        compute_sweep, params.element, params.feedstock_type, params.application_rates,
+        params.kde_rates, params.seed, params.kde_method
+    )
+    return encoded(result, accept)
+
+@app.post("/calculate-trajectory")
+async def calculate_trajectory(params: TrajectoryParams):
+    """Calculate yearly p5/p50/p95 concentrations and threshold exceedance for repeated annual application
     
-    # Create distributions using preset data
-    soil_d_dist = np.random.uniform(0.05, 0.3, 10000)  # Standard soil depth range
-    dbd_dist = get_dbd_dist()
-    feedstock_dist = get_dist(feedstock_data, element)
-    soil_dist = get_dist(soil_data, element)
+    quantiles[name][y] and exceedance[y][j] are for years[y] and thresholds[j]; year 0 is before application.
+    """
+    thresholds = threshold_records(params.element)
+    result = await worker_pool.run(
+        compute_trajectory, params.element, params.feedstock_type, params.annual_rate, params.years,
+        params.leaching_rate, params.uptake_rate, [threshold["threshold"] for threshold in thresholds], params.seed
+    )
+    if "error" in result:
+        return result
+    return {**result, "thresholds": thresholds}
+
+@app.post("/sensitivity")
+async def calculate_sensitivity(params: SensitivityParams):
+    """Calculate first-order and total Sobol indices of the preset inputs at one application rate"""
+    return await worker_pool.run(
+        compute_sensitivity, params.element, params.feedstock_type, params.application_rate,
+        params.samples, params.bootstrap, params.confidence, params.seed
+    )
+
+@app.post("/exceedance")
+async def calculate_exceedance(params: ExceedanceParams):
+    """Calculate the fraction of simulated concentrations above every threshold at every preset application rate
     
-    # Calculate KDE for feedstock and soil distributions
-    feedstock_x, feedstock_y = calculate_normalized_kde(feedstock_dist)
-    soil_x, soil_y = calculate_normalized_kde(soil_dist)
+    exceedance[i][j] is the fraction for application_rates[i] and thresholds[j].
+    """
+    thresholds = threshold_records(params.element)
+    result = await worker_pool.run(
+        compute_exceedance, params.element, params.feedstock_type,
+        [threshold["threshold"] for threshold in thresholds], params.seed
+    )
+    if "error" in result:
+        return result
+    return {**result, "thresholds": thresholds}
+
+@app.post("/max-application-rate")
+async def calculate_max_application_rate(params: MaxApplicationRateParams):
+    """Find the largest application rate keeping the requested concentration quantile under each threshold
     
-    # Determine application rates based on feedstock type
-    if feedstock_type == 'basalt':
-        application_rates = list(range(0, 126, 25))  # t = tonnes
-    elif feedstock_type == 'peridotite':
-        application_rates = list(range(0, 26, 5))    # t = tonnes
+    Uses the element's regulatory thresholds unless a list of thresholds is given.
+    """
+    if params.thresholds is None:
+        thresholds = threshold_records(params.element)
     else:
-        return {"error": "Invalid feedstock type. Must be either 'basalt' or 'peridotite'"}
+        thresholds = [{"label": None, "threshold": value, "category": None} for value in params.thresholds]
     
-    # Calculate concentrations for each application rate
-    concentrations = {}
-    for rate in application_rates:
-        conc_list = calc_element_conc_dist(rate, dbd_dist, soil_d_dist, feedstock_dist, soil_dist)
-        x_kde, y_kde = calculate_normalized_kde(np.array(conc_list))
-        concentrations[str(rate)] = {
-            "x": x_kde,
-            "y": y_kde
-        }
+    result = await worker_pool.run(
+        compute_max_application_rates, params.element, params.feedstock_type,
+        [threshold["threshold"] for threshold in thresholds], params.quantile, params.seed
+    )
+    if "error" in result:
+        return result
     
+    rates = result.pop("max_application_rates")
+    statuses = result.pop("status")
     return {
-        "distributions": {
-            "feedstock": {
-                "x": feedstock_x,
-                "y": feedstock_y
-            },
-            "soil": {
-                "x": soil_x,
-                "y": soil_y
-            }
-        },
-        "concentrations": concentrations,
-        "element": element_short,
-        "feedstock_type": feedstock_type
+        **result,
+        "thresholds": [
+            {**threshold, "max_application_rate": rate, "status": status}
+            for threshold, rate, status in zip(thresholds, rates, statuses)
+        ]
     }
 
+def custom_scenario(params):
+    """A custom scenario as the plain dict compute_custom expects, with thresholds for adaptive sampling"""
+    scenario = params.model_dump()
+    if params.tolerance:
+        scenario['thresholds'] = threshold_values(params.element)
+    return scenario
+
 @app.post("/calculate-custom")
-def calculate_custom(params: CustomCalculationParams):
+async def calculate_custom(params: CustomCalculationParams, accept: Optional[str] = Header(default=None)):
     """Calculate metal concentrations using custom parameters"""
-    # Create distributions using custom parameters
-    n = 10000
-    rng = np.random.default_rng()
-    feedstock_dist = rng.normal(loc=params.feed_conc, scale=params.feed_conc_sd, size=n)
-    soil_dist = rng.normal(loc=params.soil_conc, scale=params.soil_conc_sd, size=n)
-    dbd_dist = rng.normal(loc=params.dbd * 1000, scale=params.dbd_err * 1000, size=n)
-    soil_d_dist = rng.normal(loc=params.soil_d, scale=params.soil_d_err, size=n)
-    
-    # Calculate KDEs for feedstock and soil distributions
-    feedstock_x, feedstock_y = calculate_normalized_kde(feedstock_dist)
-    soil_x, soil_y = calculate_normalized_kde(soil_dist)
+    results = await worker_pool.run(compute_custom, [custom_scenario(params)])
+    return encoded(results[0], accept)
 
-    concentrations = {}
-    conc_list = calc_element_conc_dist(params.application_rate, dbd_dist, soil_d_dist, feedstock_dist, soil_dist)
-    x_kde, y_kde = calculate_normalized_kde(np.array(conc_list))
-    concentrations[str(params.application_rate)] = {
-            "x": x_kde,
-            "y": y_kde
-        }
+@app.post("/calculate-custom/sensitivity")
+async def calculate_custom_sensitivity(params: CustomSensitivityParams):
+    """Calculate first-order and total Sobol indices of a custom scenario's inputs"""
+    return await worker_pool.run(
+        compute_custom_sensitivity, params.model_dump(), params.samples, params.bootstrap, params.confidence
+    )
+
+async def iter_custom_results(scenarios):
+    """Yield (index, result) for each scenario, running chunks of BATCH_CHUNK_SIZE in the worker pool"""
+    scenarios = [custom_scenario(scenario) for scenario in scenarios]
+    for start in range(0, len(scenarios), BATCH_CHUNK_SIZE):
+        results = await worker_pool.run(compute_custom, scenarios[start:start + BATCH_CHUNK_SIZE])
+        for offset, result in enumerate(results):
+            yield start + offset, result
+
+@app.post("/calculate-custom/batch")
+async def calculate_custom_batch(params: BatchCustomCalculationParams, accept: Optional[str] = Header(default=None)):
+    """Calculate metal concentrations for many custom scenarios in one request
     
-    return {
-        "distributions": {
-            "feedstock": {
-                "x": feedstock_x,
-                "y": feedstock_y
-            },
-            "soil": {
-                "x": soil_x,
-                "y": soil_y
-            }
-        },
-        "concentrations": concentrations,
-        "element": params.element,
-        "feedstock_type": params.feedstock_type
-    }
+    With stream=true (or an NDJSON Accept header) the results are sent as NDJSON,
+    one line per scenario. Lines arrive in bursts of BATCH_CHUNK_SIZE scenarios,
+    as each chunk finishes in the worker pool (adaptive scenarios in a chunk run
+    one after another, so they delay its burst). The first chunk runs before the
+    response starts, so a full queue still returns a 503; a later chunk rejected
+    by the queue ends the stream with an {"error": ...} line.
+    """
+    media_type = negotiate(accept)
+    if params.stream or is_stream(media_type):
+        line_type = COMPACT_NDJSON if is_compact(media_type) else NDJSON
+        results = iter_custom_results(params.scenarios)
+        first = await anext(results, None)
+        
+        async def lines():
+            if first is None:
+                return
+            yield encode({"index": first[0], **first[1]}, line_type)
+            try:
+                async for index, result in results:
+                    yield encode({"index": index, **result}, line_type)
+            except QueueFullError as e:
+                # The response has already started, so report the failure in-stream
+                yield encode({"error": str(e)}, line_type)
+        return StreamingResponse(lines(), media_type=line_type)
+    
+    return encoded({"results": [result async for _, result in iter_custom_results(params.scenarios)]}, accept)
 
 @app.get("/thresholds")
 def get_thresholds(element: str) -> ThresholdResult:
     """Get threshold values for a specific element"""
-    return get_thresh(element)
\ No newline at end of file
+    return get_thresh(element)
+
+@app.get("/thresholds/batch")
+def get_thresholds_batch(elements: str) -> Dict[str, ThresholdResult]:
+    """Get threshold values for several comma-separated elements"""
+    return threshold_index.get_many(element.strip() for element in elements.split(",") if element.strip())
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus metrics: stage and request latency histograms, cache counters and queue depth"""
+    values = [
+        ("heavy_metal_cache_hits_total", "counter", "Result cache hits", (("cache", "preset"),), preset_cache.hits),
+        ("heavy_metal_cache_misses_total", "counter", "Result cache misses", (("cache", "preset"),), preset_cache.misses),
+        ("heavy_metal_cache_entries", "gauge", "Entries in the result cache", (("cache", "preset"),), len(preset_cache)),
+        ("heavy_metal_queue_depth", "gauge", "Calculations running or waiting in the worker pool", (), worker_pool.depth),
+        ("heavy_metal_queue_size", "gauge", "Maximum calculations running or waiting", (), worker_pool.queue_size),
+        ("heavy_metal_workers", "gauge", "Worker processes (0 runs calculations in-process)", (), worker_pool.workers),
+    ]
+    return PlainTextResponse(render(values), media_type="text/plain; version=0.0.4")
+
+ROUTE_PATHS = {route.path for route in app.routes}
@@ -0,0 +1,64 @@
+"""In-process cache for calculation results
+
+The preset endpoints only have a few dozen valid inputs, so their results are
+kept in a bounded LRU cache with TTL eviction. The whole cache is dropped as
+soon as one of the data files changes on disk.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from heavy_metal_store import data_fingerprint
+
+RESULT_CACHE_SIZE = int(os.getenv("HEAVY_METAL_RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = float(os.getenv("HEAVY_METAL_RESULT_CACHE_TTL", 24 * 60 * 60))
+
+
+class ResultCache:
+    """Bounded LRU cache with TTL eviction, invalidated when the data files change"""
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, fingerprint=data_fingerprint):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = fingerprint
+        self._data_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_data_version(self):
+        version = self._fingerprint()
+        if version != self._data_version:
+            self._entries.clear()
+            self._data_version = version
+
+    def get(self, key):
+        """Get a cached value, or None if it is missing or expired"""
+        with self._lock:
+            self._check_data_version()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries beyond maxsize"""
+        with self._lock:
+            self._check_data_version()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
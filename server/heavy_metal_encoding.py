@@ -0,0 +1,77 @@
+"""Response encodings for chart curves, negotiated by Accept header
+
+application/json (default)
+    Curves as JSON lists of floats.
+application/vnd.heavy-metal.float32+json
+    Every {"x": [...], "y": [...]} curve is sent as base64 little-endian
+    float32 strings, about a quarter of the size of the JSON lists.
+application/x-ndjson, application/vnd.heavy-metal.float32+ndjson
+    Streamed results, one JSON object per line, with curves as lists or as
+    base64 float32 respectively.
+
+Encoded responses carry "curve_encoding": "float32-base64" so a client can
+decode each curve with new Float32Array(bytes.buffer).
+"""
+import base64
+import json
+
+import numpy as np
+
+JSON = "application/json"
+COMPACT_JSON = "application/vnd.heavy-metal.float32+json"
+NDJSON = "application/x-ndjson"
+COMPACT_NDJSON = "application/vnd.heavy-metal.float32+ndjson"
+
+MEDIA_TYPES = (JSON, COMPACT_JSON, NDJSON, COMPACT_NDJSON)
+CURVE_ENCODING = "float32-base64"
+
+
+def negotiate(accept, supported=MEDIA_TYPES):
+    """Pick the supported media type the Accept header prefers, defaulting to JSON"""
+    best, best_q = JSON, 0.0
+    for part in (accept or "").split(","):
+        media_type, *params = [piece.strip() for piece in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type in supported and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def is_compact(media_type):
+    return media_type in (COMPACT_JSON, COMPACT_NDJSON)
+
+
+def is_stream(media_type):
+    return media_type in (NDJSON, COMPACT_NDJSON)
+
+
+def encode_array(values):
+    """Encode a sequence of floats as base64 little-endian float32"""
+    return base64.b64encode(np.asarray(values, dtype="<f4").tobytes()).decode("ascii")
+
+
+def compact_curves(value):
+    """Replace the x/y lists of every curve in a result with base64 float32 strings"""
+    if isinstance(value, dict):
+        if isinstance(value.get("x"), list) and isinstance(value.get("y"), list):
+            return {**value, "x": encode_array(value["x"]), "y": encode_array(value["y"])}
+        return {key: compact_curves(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [compact_curves(item) for item in value]
+    return value
+
+
+def encode(result, media_type):
+    """Encode a result dict as the body of a response in the given media type"""
+    if is_compact(media_type) and "error" not in result:
+        result = {**compact_curves(result), "curve_encoding": CURVE_ENCODING}
+    separators = (",", ":") if is_compact(media_type) else None
+    body = json.dumps(result, separators=separators)
+    return body + "\n" if is_stream(media_type) else body
@@ -0,0 +1,328 @@
+"""Persisted distribution fits for the heavy metal datasets
+
+The datasets only change between deploys, so fitting a distribution on every
+request is wasted work. Fits are stored on disk keyed by
+(dataset file hash, element column, distribution family) and are refitted
+only when a data file changes.
+
+The "selected" family is the fit registry the API samples from: every
+candidate family is fitted, the lowest-AIC parametric family that passes a KS
+test wins, and the empirical distribution of the data is used when none does
+(sparse or strongly skewed columns).
+
+Configuration:
+    HEAVY_METAL_FIT_CACHE   path of the fit cache (default: cache/fits.json)
+    HEAVY_METAL_FIT_FAMILY  family the API samples from (default: selected; gamma for the old behaviour)
+
+Warm the cache ahead of time, fitting columns in parallel processes, with:
+
+    python heavy_metal_fits.py
+"""
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.stats
+from fitter import Fitter
+from scipy.optimize import minimize
+
+from heavy_metal_store import DATASETS, file_hash, load_column
+
+logger = logging.getLogger(__name__)
+
+FIT_CACHE_PATH = os.getenv("HEAVY_METAL_FIT_CACHE", "cache/fits.json")
+
+SELECTED = "selected"
+EMPIRICAL = "empirical"
+CANDIDATE_FAMILIES = ("lognorm", "gamma", "weibull_min", "truncnorm", EMPIRICAL)
+FIT_FAMILY = os.getenv("HEAVY_METAL_FIT_FAMILY", SELECTED)
+# A parametric family is rejected when its KS test fails at KS_ALPHA and its CDF is more than
+# KS_MAX_STATISTIC away from the data's (large columns fail the test on tiny gaps)
+KS_ALPHA = 0.05
+KS_MAX_STATISTIC = 0.05
+MIN_FIT_SAMPLES = 20  # Smaller columns are sampled empirically
+MIN_DISTINCT_VALUES = 2  # Columns with fewer distinct values have no spread to sample from
+EMPIRICAL_POINTS = 1001  # Quantiles kept of larger columns
+SELECTION_VERSION = 2  # Bump when the selection logic changes so every selected fit is redone
+
+# Part of the cache key of selected fits, so changing any selection setting refits them
+SELECTION_SETTINGS = hashlib.sha256(json.dumps({
+    "version": SELECTION_VERSION,
+    "families": CANDIDATE_FAMILIES,
+    "ks_alpha": KS_ALPHA,
+    "ks_max_statistic": KS_MAX_STATISTIC,
+    "min_fit_samples": MIN_FIT_SAMPLES,
+    "min_distinct_values": MIN_DISTINCT_VALUES,
+    "empirical_points": EMPIRICAL_POINTS,
+}).encode()).hexdigest()[:16]
+
+
+class FitError(ValueError):
+    """Raised when a column has too little data to fit any distribution"""
+
+
+def fit_distribution(data, family="gamma"):
+    """Fit a distribution family to data and return its parameters and fit diagnostics"""
+    f = Fitter(data, distributions=[family])
+    f.fit()
+
+    best_fit = f.get_best(method="sumsquare_error")
+    diagnostics = f.df_errors.loc[family].to_dict()
+
+    return {
+        "params": {name: float(value) for name, value in best_fit[family].items()},
+        # JSON has no representation for inf/nan (kl_div is often inf)
+        "diagnostics": {
+            name: float(value) if math.isfinite(value) else None
+            for name, value in diagnostics.items()
+        },
+        "n": int(len(data)),
+    }
+
+
+def _diagnostics(data, dist, k):
+    """AIC/BIC from the data's log-likelihood and KS test of a frozen distribution against the data
+
+    Fitter's AIC is computed on histogram bin centres, so it is not comparable
+    between families fitted to the same data.
+    """
+    log_lik = float(np.sum(dist.logpdf(data)))
+    ks = scipy.stats.kstest(data, dist.cdf)
+    values = {
+        "aic": 2 * k - 2 * log_lik,
+        "bic": k * math.log(len(data)) - 2 * log_lik,
+        "ks_statistic": float(ks.statistic),
+        "ks_pvalue": float(ks.pvalue),
+    }
+    return {name: value if math.isfinite(value) else None for name, value in values.items()}
+
+
+def fit_truncnorm(data):
+    """Fit a normal distribution truncated below at zero (or the data minimum) by maximum likelihood
+
+    Fitter fits all four truncnorm parameters freely, which is slow and rarely
+    converges; here only loc and scale are free and a follows from the bound.
+    """
+    data = np.asarray(data, dtype=float)
+    lower = min(float(data.min()), 0.0)
+    if not data.std() > 0:
+        raise ValueError("Cannot fit truncnorm to a constant column")
+
+    def negative_log_lik(theta):
+        loc, scale = theta[0], math.exp(theta[1])
+        value = -np.sum(scipy.stats.truncnorm.logpdf(data, (lower - loc) / scale, np.inf, loc, scale))
+        return value if np.isfinite(value) else 1e300
+
+    result = minimize(negative_log_lik, [data.mean(), math.log(data.std())], method="Nelder-Mead")
+    loc, scale = float(result.x[0]), math.exp(result.x[1])
+    params = {"a": (lower - loc) / scale, "b": math.inf, "loc": loc, "scale": scale}
+    return {
+        "params": params,
+        "diagnostics": _diagnostics(data, scipy.stats.truncnorm(**params), 2),
+        "n": int(len(data)),
+    }
+
+
+def empirical_quantiles(data, points=EMPIRICAL_POINTS):
+    """Evenly spaced quantiles of the data, interpolated linearly to sample the empirical distribution"""
+    data = np.sort(np.asarray(data, dtype=float))
+    if len(data) > points:
+        data = np.quantile(data, np.linspace(0, 1, points))
+    return data.tolist()
+
+
+def _passes_ks(diagnostics):
+    return (diagnostics["ks_pvalue"] or 0.0) >= KS_ALPHA or (diagnostics["ks_statistic"] or 1.0) <= KS_MAX_STATISTIC
+
+
+def select_fit(data, families=CANDIDATE_FAMILIES):
+    """Fit every candidate family and pick the one to sample from
+
+    Among the parametric families that pass the KS test (see KS_ALPHA and
+    KS_MAX_STATISTIC) the one with the lowest AIC wins. When none pass, or the
+    column is too small to fit, the empirical distribution is used. Raises
+    FitError when the column has fewer than MIN_DISTINCT_VALUES distinct values.
+    """
+    data = np.asarray(data, dtype=float)
+    distinct = len(np.unique(data))
+    if distinct < MIN_DISTINCT_VALUES:
+        raise FitError(f"{distinct} distinct value(s), at least {MIN_DISTINCT_VALUES} are needed to fit a distribution")
+    fits, candidates = {}, {}
+    for family in families:
+        if family == EMPIRICAL or len(data) < MIN_FIT_SAMPLES:
+            continue
+        try:
+            if family == "truncnorm":
+                fit = fit_truncnorm(data)
+                diagnostics = fit["diagnostics"]
+            else:
+                fit = fit_distribution(data, family)
+                diagnostics = _diagnostics(data, getattr(scipy.stats, family)(**fit["params"]), len(fit["params"]))
+        except Exception:
+            logger.warning("Could not fit %s", family, exc_info=True)
+            continue
+        if diagnostics["aic"] is not None:
+            fits[family], candidates[family] = fit, diagnostics
+
+    accepted = [family for family in candidates if _passes_ks(candidates[family])]
+    best = min(accepted, key=lambda family: candidates[family]["aic"], default=None)
+    if best is not None:
+        selected = {"family": best, "params": fits[best]["params"]}
+    elif EMPIRICAL in families:
+        selected = {"family": EMPIRICAL, "params": {}, "quantiles": empirical_quantiles(data)}
+    else:
+        raise ValueError(f"None of {', '.join(families)} fits the data")
+    return {**selected, "candidates": candidates, "n": int(len(data))}
+
+
+def fit_column(dataset, column, family="gamma"):
+    """Fit one dataset column; a module-level function so it can run in worker processes"""
+    data = load_column(dataset, column)
+    if family != SELECTED:
+        return fit_distribution(data, family)
+    try:
+        return select_fit(data)
+    except FitError as e:
+        raise FitError(f"Cannot fit {column} in the {dataset} data: {e}") from e
+
+
+def fit_ppf(fit, q):
+    """Inverse CDF of a fit record (with its "family") at probabilities q"""
+    if fit["family"] == EMPIRICAL:
+        quantiles = fit["quantiles"]
+        return np.interp(q, np.linspace(0, 1, len(quantiles)), quantiles)
+    return getattr(scipy.stats, fit["family"]).ppf(q, **fit["params"])
+
+
+def fit_rvs(fit, size, rng=None):
+    """Draw samples from a fit record (with its "family")"""
+    if fit["family"] == EMPIRICAL:
+        return fit_ppf(fit, np.random.default_rng(rng).random(size))
+    return getattr(scipy.stats, fit["family"]).rvs(**fit["params"], size=size, random_state=rng)
+
+
+class FitCache:
+    """Distribution fits keyed by (dataset file hash, element column, family), persisted as JSON"""
+
+    def __init__(self, path=FIT_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fits = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring unreadable fit cache at %s", self.path)
+            return {}
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._fits, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def key(dataset_hash, column, family):
+        if family == SELECTED:
+            family = f"{SELECTED}-{SELECTION_SETTINGS}"
+        return f"{dataset_hash}:{column}:{family}"
+
+    def get(self, dataset, column, family="gamma", save=True):
+        """Get the fit for a dataset column, fitting and persisting it on a miss"""
+        key = self.key(file_hash(DATASETS[dataset]), column, family)
+        with self._lock:
+            fit = self._fits.get(key)
+        if fit is not None:
+            return fit
+
+        fit = fit_column(dataset, column, family)
+        with self._lock:
+            self._fits[key] = fit
+            if save:
+                self._write()
+        return fit
+
+    def warm(self, columns, family="gamma", workers=1):
+        """Fit every (dataset, column) pair that is not cached yet and persist once at the end
+
+        With workers > 1 the missing fits run in that many processes.
+        """
+        missing = []
+        for dataset, column in columns:
+            if not os.path.exists(DATASETS[dataset]):
+                logger.warning("Skipping %s: %s not found", column, DATASETS[dataset])
+                continue
+            with self._lock:
+                if self.key(file_hash(DATASETS[dataset]), column, family) not in self._fits:
+                    missing.append((dataset, column))
+
+        if workers > 1 and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(missing)),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(fit_column, dataset, column, family) for dataset, column in missing]
+                fits = []
+                for (dataset, column), future in zip(missing, futures):
+                    try:
+                        fits.append((dataset, column, future.result()))
+                    except FitError as e:
+                        logger.warning("%s", e)
+                    except Exception:
+                        logger.warning("Could not fit %s to %s in %s", family, column, dataset, exc_info=True)
+            with self._lock:
+                for dataset, column, fit in fits:
+                    self._fits[self.key(file_hash(DATASETS[dataset]), column, family)] = fit
+        else:
+            for dataset, column in missing:
+                try:
+                    self.get(dataset, column, family, save=False)
+                except FitError as e:
+                    logger.warning("%s", e)
+                except Exception:
+                    # Fitter drops families it cannot fit (e.g. a column with a single value)
+                    logger.warning("Could not fit %s to %s in %s", family, column, dataset, exc_info=True)
+        with self._lock:
+            self._write()
+
+
+fit_cache = FitCache()
+
+
+def get_fit(dataset, column, family=FIT_FAMILY):
+    """Get the fit record the API samples from, with its "family" (the winner for the selected family)"""
+    return {"family": family, **fit_cache.get(dataset, column, family)}
+
+
+def element_columns(elements_by_feedstock):
+    """List the (dataset, column) pairs used by the API for the given elements"""
+    columns = []
+    for feedstock_type, elements in elements_by_feedstock.items():
+        for element in elements:
+            column = f"{element} (mg/kg)"
+            columns.append((feedstock_type, column))
+            if ("soil", column) not in columns:
+                columns.append(("soil", column))
+    return columns
+
+
+if __name__ == "__main__":
+    import time
+
+    from heavy_metal_core import ELEMENTS
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    fit_cache.warm(element_columns(ELEMENTS), FIT_FAMILY, workers=os.cpu_count() or 1)
+    print(f"Warmed {len(fit_cache._fits)} fits in {time.perf_counter() - start:.1f}s -> {fit_cache.path}")
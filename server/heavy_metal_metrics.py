@@ -0,0 +1,162 @@
+"""Timing spans and Prometheus metrics
+
+Stages of a calculation are wrapped in span("name"). While a request is being
+handled its spans are collected, including those run in worker processes,
+which return their spans alongside the result. When the request finishes they
+feed the stage histograms served at /metrics and, optionally, a Server-Timing
+response header.
+
+Configuration:
+    HEAVY_METAL_METRICS        1 to enable spans and request metrics (default: 0)
+    HEAVY_METAL_SERVER_TIMING  1 to add a Server-Timing header to responses (needs HEAVY_METAL_METRICS)
+
+When disabled, span() returns a shared no-op context manager, so an
+instrumented stage costs one function call.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+
+ENABLED = os.getenv("HEAVY_METAL_METRICS", "0") == "1"
+SERVER_TIMING = ENABLED and os.getenv("HEAVY_METAL_SERVER_TIMING", "0") == "1"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# (name, seconds) spans of the request being handled, or None outside a request
+_spans = contextvars.ContextVar("heavy_metal_spans", default=None)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((self.name, time.perf_counter() - self.start))
+        return False
+
+
+def span(name):
+    """Time a stage of the current request"""
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+def start_request():
+    """Start collecting spans for the current request; returns (spans, token)"""
+    spans = []
+    return spans, _spans.set(spans)
+
+
+def end_request(token):
+    _spans.reset(token)
+
+
+def add_spans(spans):
+    """Add spans recorded elsewhere (e.g. in a worker process) to the current request"""
+    current = _spans.get()
+    if current is not None:
+        current.extend(spans)
+
+
+def collect(fn, *args):
+    """Run fn(*args) and return (result, spans), for calls made in worker processes"""
+    spans = []
+    token = _spans.set(spans)
+    try:
+        return fn(*args), spans
+    finally:
+        _spans.reset(token)
+
+
+def server_timing(spans, total):
+    """Format spans as a Server-Timing header value, summing repeated stages"""
+    durations = defaultdict(float)
+    for name, seconds in spans:
+        durations[name] += seconds
+    parts = [f"{name};dur={1000 * seconds:.2f}" for name, seconds in durations.items()]
+    parts.append(f"total;dur={1000 * total:.2f}")
+    return ", ".join(parts)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    """Prometheus histogram keyed by a tuple of (label, value) pairs"""
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+stage_seconds = Histogram("heavy_metal_stage_seconds", "Time spent in each calculation stage")
+request_seconds = Histogram("heavy_metal_request_seconds", "Request latency by endpoint and status")
+
+
+def record_request(endpoint, status, seconds, spans):
+    for name, duration in spans:
+        stage_seconds.observe((("stage", name),), duration)
+    request_seconds.observe((("endpoint", endpoint), ("status", str(status))), seconds)
+
+
+def render(values):
+    """Render the histograms plus (name, type, help, labels, value) samples in the Prometheus text format"""
+    lines = []
+    described = set()
+    for name, kind, help, labels, value in values:
+        if name not in described:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            described.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    lines += stage_seconds.render() + request_seconds.render()
+    return "\n".join(lines) + "\n"
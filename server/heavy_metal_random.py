@@ -0,0 +1,38 @@
+"""Reproducible random streams for the calculations
+
+Each calculation takes one seed, generated when the request has none and
+echoed in the response, and derives independent generators from it by name:
+streams.get("soil") for the soil baseline, streams.get("rate", i) for the i-th
+application rate. A stream depends only on the seed and its key, so the parts
+of a calculation can be drawn in any order or in different processes and still
+match a sequential run byte for byte.
+"""
+import secrets
+import zlib
+
+import numpy as np
+
+SEED_BITS = 53  # Generated seeds stay exact as JavaScript numbers
+
+
+def new_seed():
+    """Generate a seed for a request that did not give one"""
+    return secrets.randbits(SEED_BITS)
+
+
+class RandomStreams:
+    """Independent, named random generators derived from one seed"""
+
+    def __init__(self, seed=None):
+        self.seed = new_seed() if seed is None else int(seed)
+        if self.seed < 0:
+            raise ValueError(f"Seed must be a non-negative integer, got {seed}")
+
+    def get(self, name, *index):
+        """Get a fresh generator for a named stream, e.g. get("rate", 2)
+
+        Calling get twice with the same key returns generators that produce the
+        same draws, so each key should be used for one purpose only.
+        """
+        spawn_key = (zlib.crc32(name.encode()), *(int(i) for i in index))
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=spawn_key))
@@ -0,0 +1,139 @@
+"""Geographically filtered soil baselines
+
+The soil dataset carries a location, state and land cover for most samples.
+A region is a plain dict with any of:
+
+    latitude, longitude + radius_km   samples within radius_km of the point
+    latitude, longitude + nearest     the nearest samples to the point
+    state                             two-letter state code, e.g. "TX"
+    land_cover                        matched case-insensitively against LandCover1/LandCover2
+
+Location queries go through a KD-tree built once per store version on 3D unit
+vectors, where great-circle distance maps monotonically to chord length, so it
+returns the same samples as a haversine search. Fits are cached per set of
+matching samples, so every request that selects the same samples shares a fit.
+"""
+import hashlib
+import math
+import threading
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from heavy_metal_cache import ResultCache
+from heavy_metal_fits import fit_distribution
+from heavy_metal_store import dataset_dir, load_metadata, load_table
+
+EARTH_RADIUS_KM = 6371.0
+MIN_REGION_SAMPLES = 20  # Fewer samples than this do not support a distribution fit
+
+_indexes = {}
+_lock = threading.Lock()
+region_fits = ResultCache()
+
+
+class RegionError(ValueError):
+    """Raised when a region is invalid or matches too few samples"""
+
+
+def _unit_vectors(latitude, longitude):
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+class SpatialIndex:
+    """KD-tree over the located samples of a dataset"""
+
+    def __init__(self, dataset):
+        latitude = np.asarray(load_metadata(dataset, "Latitude"))
+        longitude = np.asarray(load_metadata(dataset, "Longitude"))
+        located = ~(np.isnan(latitude) | np.isnan(longitude))
+        self.rows = np.flatnonzero(located)
+        self.tree = cKDTree(_unit_vectors(latitude[located], longitude[located]))
+
+    def within(self, latitude, longitude, radius_km):
+        """Row numbers of the samples within radius_km of a point"""
+        chord = 2 * math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2)
+        point = _unit_vectors([latitude], [longitude])[0]
+        return self.rows[np.asarray(self.tree.query_ball_point(point, chord), dtype=int)]
+
+    def nearest(self, latitude, longitude, k, eligible):
+        """Row numbers of the k nearest samples to a point among the eligible rows"""
+        point = _unit_vectors([latitude], [longitude])[0]
+        n = len(self.rows)
+        query_k = min(n, k)
+        while True:
+            _, positions = self.tree.query(point, k=max(query_k, 1))
+            rows = self.rows[np.atleast_1d(positions)]
+            rows = rows[eligible[rows]]
+            if len(rows) >= k or query_k >= n:
+                return rows[:k]
+            query_k = min(n, query_k * 2)
+
+
+def spatial_index(dataset):
+    """Get the spatial index of a dataset, building it once per store version"""
+    directory = dataset_dir(dataset)
+    index = _indexes.get(directory)
+    if index is None:
+        with _lock:
+            index = _indexes.get(directory)
+            if index is None:
+                index = SpatialIndex(dataset)
+                _indexes[directory] = index
+    return index
+
+
+def region_rows(dataset, column, region):
+    """Row numbers of the samples in a region that have a value for column"""
+    values = load_table(dataset, [column])[:, 0]
+    eligible = ~np.isnan(values)
+
+    state = region.get("state")
+    if state:
+        eligible &= np.char.upper(np.asarray(load_metadata(dataset, "State"))) == state.upper()
+
+    land_cover = region.get("land_cover")
+    if land_cover:
+        land_cover = land_cover.lower()
+        eligible &= (
+            (np.char.lower(np.asarray(load_metadata(dataset, "LandCover1"))) == land_cover)
+            | (np.char.lower(np.asarray(load_metadata(dataset, "LandCover2"))) == land_cover)
+        )
+
+    latitude, longitude = region.get("latitude"), region.get("longitude")
+    if (latitude is None) != (longitude is None):
+        raise RegionError("latitude and longitude must be given together")
+    if latitude is None:
+        if region.get("radius_km") is not None or region.get("nearest") is not None:
+            raise RegionError("radius_km and nearest require latitude and longitude")
+        return np.flatnonzero(eligible)
+
+    index = spatial_index(dataset)
+    if region.get("nearest") is not None:
+        rows = index.nearest(latitude, longitude, region["nearest"], eligible)
+        if region.get("radius_km") is not None:
+            rows = np.intersect1d(rows, index.within(latitude, longitude, region["radius_km"]))
+        return np.sort(rows)
+    if region.get("radius_km") is not None:
+        rows = index.within(latitude, longitude, region["radius_km"])
+        return np.sort(rows[eligible[rows]])
+    raise RegionError("latitude and longitude require radius_km or nearest")
+
+
+def get_region_fit(dataset, column, region, family="gamma"):
+    """Fit a distribution family to the samples of a column in a region, cached per set of samples"""
+    rows = region_rows(dataset, column, region)
+    if len(rows) < MIN_REGION_SAMPLES:
+        raise RegionError(
+            f"Only {len(rows)} {dataset} samples with {column} match the region; "
+            f"at least {MIN_REGION_SAMPLES} are needed"
+        )
+
+    key = (dataset_dir(dataset), column, family, hashlib.sha256(rows.tobytes()).hexdigest())
+    fit = region_fits.get(key)
+    if fit is None:
+        fit = fit_distribution(np.asarray(load_table(dataset, [column])[rows, 0]), family)
+        region_fits.set(key, fit)
+    return fit
@@ -0,0 +1,157 @@
+"""Global sensitivity analysis of the concentration model (Sobol indices)
+
+Which input drives the soil concentration at an application rate: soil depth,
+feedstock concentration, baseline soil concentration or bulk density. Inputs
+are drawn with Saltelli's scheme from a scrambled Sobol sequence mapped through
+each input's inverse CDF, and calc_element_conc is evaluated on all
+N x (k + 2) points in one array call. First-order indices use the Saltelli
+(2010) estimator and total indices the Jansen estimator; confidence intervals
+come from bootstrap resamples of the N rows, evaluated as one matrix product
+per chunk of resamples.
+"""
+import numpy as np
+from scipy.stats import qmc
+
+from heavy_metal_core import (
+    INPUT_NAMES, INVALID_FEEDSTOCK_ERROR, PRESET_APPLICATION_RATES, calc_element_conc, custom_input_ppfs,
+    preset_input_ppfs
+)
+from heavy_metal_fits import FitError
+from heavy_metal_metrics import span
+from heavy_metal_random import RandomStreams
+
+SOBOL_SAMPLES = 4096  # N, rounded up to a power of two
+BOOTSTRAP_RESAMPLES = 200
+BOOTSTRAP_CHUNK_DRAWS = 2 ** 22  # Resamples evaluated together are bounded to about this many row counts
+
+
+def saltelli_matrices(ppfs, n, rng=None):
+    """Draw Saltelli's A, B (n, k) and AB (k, n, k) matrices, where AB[i] is A with column i taken from B
+
+    Rows come from a 2k-dimensional scrambled Sobol sequence; columns i and k + i
+    both map to input i through ppfs[i]. n is rounded up to a power of two.
+    """
+    k = len(ppfs)
+    u = qmc.Sobol(2 * k, scramble=True, rng=rng).random_base2(int(np.ceil(np.log2(n))))
+    x = np.column_stack([ppfs[j % k](u[:, j]) for j in range(2 * k)])
+    a, b = x[:, :k], x[:, k:]
+    ab = np.repeat(a[np.newaxis], k, axis=0)
+    ab[np.arange(k), :, np.arange(k)] = b.T
+    return a, b, ab
+
+
+def row_terms(f_a, f_b, f_ab):
+    """Per-row terms whose means give the variance and both estimators, shape (n, 2k + 2)
+
+    f_a and f_b have shape (n,) and f_ab (k, n). Outputs are centred first so the
+    variance from mean squares does not lose precision.
+    """
+    center = (f_a.mean() + f_b.mean()) / 2
+    a, b, ab = f_a - center, f_b - center, f_ab - center
+    return np.column_stack([a + b, a ** 2 + b ** 2, (b * (ab - a)).T, (0.5 * (a - ab) ** 2).T])
+
+
+def sobol_estimates(means, k):
+    """First-order (Saltelli 2010) and total (Jansen) indices from means of row_terms, shape (..., 2k + 2)"""
+    variance = means[..., 1:2] / 2 - (means[..., 0:1] / 2) ** 2  # Over the 2n outputs of A and B
+    return means[..., 2:2 + k] / variance, means[..., 2 + k:] / variance
+
+
+def sobol_indices(ppfs, model, n=SOBOL_SAMPLES, rng=None, bootstrap=BOOTSTRAP_RESAMPLES, confidence=0.95,
+                  bootstrap_rng=None):
+    """Estimate first-order and total Sobol indices of model(x), x[..., i] being input i
+
+    Each bootstrap resample is a vector of row counts, so a chunk of resamples is
+    one (resamples, n) @ (n, 2k + 2) product with the row terms.
+    Returns (first_order, total, first_order_ci, total_ci, n); the intervals have
+    shape (k, 2) and are None without bootstrap resamples.
+    """
+    k = len(ppfs)
+    a, b, ab = saltelli_matrices(ppfs, n, rng)
+    n = len(a)
+    with span('sensitivity'):
+        f_a, f_b, f_ab = model(a), model(b), model(ab)
+        if np.ptp(np.concatenate([f_a, f_b])) == 0:
+            raise ValueError("The concentration does not vary with the inputs")
+        terms = row_terms(f_a, f_b, f_ab)
+        first_order, total = sobol_estimates(terms.mean(axis=0), k)
+        if not bootstrap:
+            return first_order, total, None, None, n
+
+        bootstrap_rng = np.random.default_rng(bootstrap_rng)
+        chunk = max(1, BOOTSTRAP_CHUNK_DRAWS // n)
+        means = []
+        for start in range(0, bootstrap, chunk):
+            size = min(chunk, bootstrap - start)
+            rows = bootstrap_rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, np.newaxis]
+            counts = np.bincount(rows.ravel(), minlength=size * n).reshape(size, n)
+            means.append(counts @ terms / n)
+        first_order_samples, total_samples = sobol_estimates(np.concatenate(means), k)
+        probabilities = [(1 - confidence) / 2, (1 + confidence) / 2]
+        first_order_ci = np.quantile(first_order_samples, probabilities, axis=0).T
+        total_ci = np.quantile(total_samples, probabilities, axis=0).T
+    return first_order, total, first_order_ci, total_ci, n
+
+
+def concentration_model(t):
+    """calc_element_conc at application rate t as a function of stacked INPUT_NAMES columns"""
+    def model(x):
+        soil_d, feedstock_conc, soil_conc, dbd = np.moveaxis(x, -1, 0)
+        return calc_element_conc(np.maximum(soil_d, 1), feedstock_conc, soil_conc, dbd, t)  # Ensure soil_d >= 1
+    return model
+
+
+def sensitivity_result(ppfs, application_rate, streams, samples, bootstrap, confidence):
+    try:
+        first_order, total, first_order_ci, total_ci, n = sobol_indices(
+            ppfs, concentration_model(application_rate), samples, streams.get('sobol'),
+            bootstrap, confidence, streams.get('bootstrap')
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+
+    indices = {}
+    for i, name in enumerate(INPUT_NAMES):
+        indices[name] = {"first_order": float(first_order[i]), "total": float(total[i])}
+        if bootstrap:
+            indices[name]["first_order_ci"] = first_order_ci[i].tolist()
+            indices[name]["total_ci"] = total_ci[i].tolist()
+    return {
+        "indices": indices,
+        "application_rate": application_rate,
+        "samples": n,
+        "evaluations": n * (len(INPUT_NAMES) + 2),
+        "bootstrap": bootstrap,
+        "confidence": confidence,
+        "seed": streams.seed
+    }
+
+
+def compute_sensitivity(element_short, feedstock_type, application_rate, samples=SOBOL_SAMPLES,
+                        bootstrap=BOOTSTRAP_RESAMPLES, confidence=0.95, seed=None):
+    """Calculate Sobol indices of the preset inputs at one application rate"""
+    element = f"{element_short} (mg/kg)"
+    streams = RandomStreams(seed)
+
+    if feedstock_type not in PRESET_APPLICATION_RATES:
+        return INVALID_FEEDSTOCK_ERROR
+
+    try:
+        ppfs = preset_input_ppfs(element, feedstock_type)
+    except FitError as e:
+        return {"error": str(e)}
+    result = sensitivity_result(ppfs, application_rate, streams, samples, bootstrap, confidence)
+    if "error" in result:
+        return result
+    return {**result, "element": element_short, "feedstock_type": feedstock_type}
+
+
+def compute_custom_sensitivity(params, samples=SOBOL_SAMPLES, bootstrap=BOOTSTRAP_RESAMPLES, confidence=0.95):
+    """Calculate Sobol indices of a custom scenario's inputs at its application rate"""
+    streams = RandomStreams(params.get('seed'))
+    result = sensitivity_result(
+        custom_input_ppfs(params), params['application_rate'], streams, samples, bootstrap, confidence
+    )
+    if "error" in result:
+        return result
+    return {**result, "element": params['element'], "feedstock_type": params['feedstock_type']}
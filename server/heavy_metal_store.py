@@ -0,0 +1,196 @@
+"""Columnar store for the heavy metal datasets
+
+The CSVs carry ~50 columns (sample IDs, locations, notes, links) of which only
+the element columns are used. Each dataset is converted once into one .npy
+array per element column with missing values already dropped, plus a
+row-aligned table of all element columns (missing values kept as NaN) for
+calculations that need whole samples, and row-aligned sample metadata
+(location, state, land cover). Arrays are memory-mapped on first use.
+
+Store directories are named after the hash of their source CSV, so a changed
+CSV is rebuilt automatically and readers never see a half-written store.
+
+Build the store ahead of time with:
+
+    python heavy_metal_store.py
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+DATASETS = {
+    "soil": "data/cleaned_soil_data.csv",
+    "basalt": "data/cleaned_feedstock_data_basalt.csv",
+    "peridotite": "data/cleaned_feedstock_data_peridotite.csv",
+}
+
+STORE_DIR = os.getenv("HEAVY_METAL_STORE", "cache/store")
+STORE_VERSION = 3  # Bump when the layout changes so old stores are rebuilt
+
+# Sample metadata kept row-aligned with table.npy; numeric columns as float, others as strings
+METADATA_COLUMNS = {
+    "Latitude": np.float64,
+    "Longitude": np.float64,
+    "State": str,
+    "LandCover1": str,
+    "LandCover2": str,
+    "Depth (cm)": str,
+}
+
+_hashes = {}
+_columns = {}
+_indexes = {}
+_lock = threading.Lock()
+
+
+def file_hash(path):
+    """Get the SHA-256 of a data file, rehashing only when it changes on disk"""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    value = digest.hexdigest()
+
+    with _lock:
+        _hashes[path] = (signature, value)
+    return value
+
+
+def data_fingerprint():
+    """Get the hashes of all data files that exist, to detect when any of them changes"""
+    return tuple(
+        (dataset, file_hash(path))
+        for dataset, path in DATASETS.items()
+        if os.path.exists(path)
+    )
+
+
+def dataset_dir(dataset):
+    """Get the store directory for the current version of a dataset"""
+    return os.path.join(STORE_DIR, f"{dataset}-v{STORE_VERSION}-{file_hash(DATASETS[dataset])[:16]}")
+
+
+def build_dataset(dataset):
+    """Convert a dataset CSV into per-element-column .npy files and a row-aligned table, if not built already"""
+    target = dataset_dir(dataset)
+    if os.path.isdir(target):
+        return target
+
+    df = pd.read_csv(DATASETS[dataset])
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{dataset}-", dir=STORE_DIR)
+
+    index = {}
+    table = []
+    for column in df.columns:
+        if "mg/kg" not in column:
+            continue
+        values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64)
+        filename = re.sub(r"[^A-Za-z0-9]+", "_", column).strip("_") + ".npy"
+        np.save(os.path.join(tmp_dir, filename), values[~np.isnan(values)])
+        index[column] = {"file": filename, "table_column": len(table)}
+        table.append(values)
+    np.save(os.path.join(tmp_dir, "table.npy"), np.column_stack(table))
+
+    metadata = {}
+    for column, dtype in METADATA_COLUMNS.items():
+        if column not in df.columns:
+            continue
+        if dtype is str:
+            values = df[column].fillna("").astype(str).to_numpy(dtype=str)
+        else:
+            values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=dtype)
+        filename = "meta_" + re.sub(r"[^A-Za-z0-9]+", "_", column).strip("_") + ".npy"
+        np.save(os.path.join(tmp_dir, filename), values)
+        metadata[column] = filename
+
+    with open(os.path.join(tmp_dir, "columns.json"), "w") as f:
+        json.dump(index, f, indent=1)
+    with open(os.path.join(tmp_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=1)
+
+    try:
+        os.rename(tmp_dir, target)
+    except OSError:
+        # Another process finished building the same version first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target
+
+
+def _column_index(directory, name="columns.json"):
+    key = (directory, name)
+    index = _indexes.get(key)
+    if index is None:
+        with open(os.path.join(directory, name)) as f:
+            index = json.load(f)
+        _indexes[key] = index
+    return index
+
+
+def _load(directory, filename):
+    key = (directory, filename)
+    values = _columns.get(key)
+    if values is None:
+        values = np.load(os.path.join(directory, filename), mmap_mode="r")
+        _columns[key] = values
+    return values
+
+
+def _current_dir(dataset):
+    directory = dataset_dir(dataset)
+    if not os.path.isdir(directory):
+        build_dataset(dataset)
+    return directory
+
+
+def load_column(dataset, column):
+    """Load one element column of a dataset (missing values dropped) as a read-only array"""
+    directory = _current_dir(dataset)
+    return _load(directory, _column_index(directory)[column]["file"])
+
+
+def load_table(dataset, columns):
+    """Load element columns of a dataset as a row-aligned (samples, columns) array with NaN for missing values"""
+    directory = _current_dir(dataset)
+    index = _column_index(directory)
+    return _load(directory, "table.npy")[:, [index[column]["table_column"] for column in columns]]
+
+
+def load_metadata(dataset, column):
+    """Load a sample metadata column (e.g. Latitude, State), row-aligned with load_table"""
+    directory = _current_dir(dataset)
+    return _load(directory, _column_index(directory, "metadata.json")[column])
+
+
+def build_store():
+    """Build every dataset that exists and remove store versions whose CSV has changed"""
+    built = []
+    for dataset, path in DATASETS.items():
+        if not os.path.exists(path):
+            continue
+        current = build_dataset(dataset)
+        built.append(current)
+        for name in os.listdir(STORE_DIR):
+            stale = os.path.join(STORE_DIR, name)
+            if name.startswith(f"{dataset}-") and stale != current:
+                shutil.rmtree(stale, ignore_errors=True)
+    return built
+
+
+if __name__ == "__main__":
+    for directory in build_store():
+        print(f"{directory}: {len(_column_index(directory))} columns")
@@ -0,0 +1,115 @@
+"""Regulatory thresholds indexed by element
+
+model_thresholds.csv is parsed once into immutable ThresholdResult objects per
+element, so a lookup is a dictionary access. The index is rebuilt when the CSV
+changes on disk and swapped in as a whole, so concurrent readers always see
+either the old or the new thresholds.
+"""
+import math
+import os
+import threading
+from typing import Dict, Iterable, Tuple
+
+import pandas as pd
+from pydantic import BaseModel, ConfigDict
+
+THRESHOLDS_PATH = "data/model_thresholds.csv"
+
+
+class ThresholdEntry(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    label: str
+    threshold: float
+
+
+class ThresholdResult(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    Total: Tuple[ThresholdEntry, ...]
+    Aqua_regia: Tuple[ThresholdEntry, ...]
+    Other_very_strong_acid: Tuple[ThresholdEntry, ...]
+
+    def entries(self):
+        """Yield (category, entry) for every threshold"""
+        for category, entries in self:
+            for entry in entries:
+                yield category, entry
+
+
+EMPTY_THRESHOLDS = ThresholdResult(Total=(), Aqua_regia=(), Other_very_strong_acid=())
+
+
+def parse_thresholds(path=THRESHOLDS_PATH) -> Dict[str, ThresholdResult]:
+    """Parse the thresholds CSV into a ThresholdResult per element, categorized by extraction type"""
+    threshold_data = pd.read_csv(path)
+
+    by_element = {}
+    for element, value, label, extraction_type in zip(
+        threshold_data["Metal"],
+        threshold_data["Threshold Level (mg/kg)"],
+        threshold_data["Label"],
+        threshold_data["Total, Aqua regia, extractable, or other (specify)"],
+    ):
+        if pd.isna(extraction_type):
+            continue
+
+        # Clean and convert threshold value, e.g. "1,500.00"
+        try:
+            threshold_value = float(value.replace(",", "") if isinstance(value, str) else value)
+        except (ValueError, TypeError):
+            continue
+        if not math.isfinite(threshold_value):
+            continue
+
+        categories = by_element.setdefault(element, {
+            "Total": [],
+            "Aqua_regia": [],
+            "Other_very_strong_acid": []
+        })
+        entry = ThresholdEntry(label=label, threshold=threshold_value)
+
+        # Categorize based on extraction type
+        if "total" in extraction_type.lower():
+            categories["Total"].append(entry)
+        elif "aqua regia" in extraction_type.lower():
+            categories["Aqua_regia"].append(entry)
+        else:
+            categories["Other_very_strong_acid"].append(entry)
+
+    return {
+        element: ThresholdResult(**{name: tuple(entries) for name, entries in categories.items()})
+        for element, categories in by_element.items()
+    }
+
+
+class ThresholdIndex:
+    """Per-element thresholds, reloaded atomically when the CSV changes"""
+
+    def __init__(self, path=THRESHOLDS_PATH):
+        self.path = path
+        self._signature = None
+        self._thresholds = {}
+        self._lock = threading.Lock()
+
+    def _current(self) -> Dict[str, ThresholdResult]:
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    self._thresholds = parse_thresholds(self.path)
+                    self._signature = signature
+        return self._thresholds
+
+    def get(self, element) -> ThresholdResult:
+        """Get the thresholds for one element (empty if it has none)"""
+        return self._current().get(element, EMPTY_THRESHOLDS)
+
+    def get_many(self, elements: Iterable[str]) -> Dict[str, ThresholdResult]:
+        """Get the thresholds for several elements from the same version of the CSV"""
+        thresholds = self._current()
+        return {element: thresholds.get(element, EMPTY_THRESHOLDS) for element in elements}
+
+
+threshold_index = ThresholdIndex()
@@ -0,0 +1,86 @@
+"""Process pool for the CPU-bound calculation core
+
+The calculations are NumPy/SciPy work that holds the GIL for most of a request,
+so they run in a pool of worker processes instead of on the event loop.
+
+Configuration:
+    HEAVY_METAL_WORKERS     number of worker processes (default: CPU count);
+                            0 runs calculations in the event loop's thread pool
+    HEAVY_METAL_QUEUE_SIZE  maximum calculations running or waiting (default: 4 per worker);
+                            further requests are rejected with a 503
+"""
+import asyncio
+import importlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+from heavy_metal_metrics import ENABLED as METRICS_ENABLED, add_spans, collect, span
+
+WORKERS = int(os.getenv("HEAVY_METAL_WORKERS", os.cpu_count() or 1))
+QUEUE_SIZE = int(os.getenv("HEAVY_METAL_QUEUE_SIZE", 4 * max(WORKERS, 1)))
+
+
+class QueueFullError(Exception):
+    """Raised when the calculation queue is full"""
+
+
+def _preload(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+class WorkerPool:
+    """Bounded queue in front of a process pool"""
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.depth = 0
+        self._executor = None
+
+    def start(self, preload=()):
+        """Start the worker processes and import the preload modules in each of them"""
+        if self.workers > 0 and self._executor is None:
+            # spawn rather than fork: the parent runs an event loop and threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            # Workers are created on demand, so submitting one task each starts them all now
+            # rather than on the first requests
+            for future in [self._executor.submit(_preload, preload) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        """Run fn(*args) in the pool, raising QueueFullError instead of queueing past queue_size"""
+        # Only touched from the event loop thread, so no lock is needed
+        if self.depth >= self.queue_size:
+            raise QueueFullError(f"Calculation queue is full ({self.queue_size} pending)")
+
+        self.depth += 1
+        try:
+            if not METRICS_ENABLED:
+                return await self._submit(fn, *args)
+            # Spans recorded in the worker come back with the result
+            with span("worker"):
+                result, spans = await self._submit(collect, fn, *args)
+            add_spans(spans)
+            return result
+        finally:
+            self.depth -= 1
+
+    async def _submit(self, fn, *args):
+        if self._executor is None:
+            return await run_in_threadpool(fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+
+worker_pool = WorkerPool()
@@ -0,0 +1,233 @@
+"""Benchmarks for the calculation stages and endpoints, with a regression gate
+
+Times each stage of a preset calculation (fit, sampling, KDE, serialization),
+/calculate-preset for every element/feedstock pair through the FastAPI
+TestClient, and a concurrent load scenario. Results are written as JSON and
+compared against a baseline: the run fails if any benchmark's median is more
+than --threshold slower. The accuracy benchmarks compare the p5/p50/p95
+concentration error of each input sampler (random, Latin hypercube, scrambled
+Sobol) against the draw count; they are reported but not gated.
+
+    python run_heavy_metal_benchmarks.py --save-baseline       # record benchmarks/baseline.json
+    python run_heavy_metal_benchmarks.py --threshold 0.2       # compare against it
+    python run_heavy_metal_benchmarks.py --require-baseline    # in CI: fail if there is no baseline
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Endpoint timings measure the calculation itself, not inter-process overhead
+os.environ.setdefault("HEAVY_METAL_WORKERS", "0")
+
+DEFAULT_BASELINE = "benchmarks/baseline.json"
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "runs": len(times),
+        "median_ms": 1000 * statistics.median(times),
+        "p95_ms": 1000 * times[min(int(len(times) * 0.95), len(times) - 1)],
+        "min_ms": 1000 * times[0],
+    }
+
+
+def timed(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def stage_benchmarks(repeat, element_short="Ni", feedstock_type="basalt"):
+    """Time each stage of a preset calculation in isolation"""
+    from heavy_metal_core import (
+        PRESET_APPLICATION_RATES, calculate_normalized_kde, compute_preset, preset_input_ppfs,
+        sample_conc_from_ppfs, sample_element_conc, sample_preset_inputs
+    )
+    from heavy_metal_encoding import COMPACT_JSON, encode
+    from heavy_metal_fits import fit_distribution
+    from heavy_metal_random import RandomStreams
+    from heavy_metal_store import load_column
+
+    element = f"{element_short} (mg/kg)"
+    rates = PRESET_APPLICATION_RATES[feedstock_type]
+    data = load_column(feedstock_type, element)
+    inputs = sample_preset_inputs(element, feedstock_type, RandomStreams(0))
+    conc_dist = sample_element_conc(rates, *inputs, rng=RandomStreams(0))[-1]
+    result = compute_preset(element_short, feedstock_type, 0)
+    ppfs = preset_input_ppfs(element, feedstock_type)
+
+    return {
+        "fit/gamma": timed(lambda i: fit_distribution(data, "gamma"), max(repeat // 5, 3)),
+        "sampling/inputs": timed(lambda i: sample_preset_inputs(element, feedstock_type, RandomStreams(i)), repeat),
+        "sampling/rates": timed(lambda i: sample_element_conc(rates, *inputs, rng=RandomStreams(i)), repeat),
+        "sampling/lhs": timed(lambda i: sample_conc_from_ppfs(ppfs, rates[-1], sampler="lhs", rng=i), repeat),
+        "sampling/sobol": timed(lambda i: sample_conc_from_ppfs(ppfs, rates[-1], sampler="sobol", rng=i), repeat),
+        "kde/binned": timed(lambda i: calculate_normalized_kde(conc_dist, method="binned"), repeat),
+        "kde/exact": timed(lambda i: calculate_normalized_kde(conc_dist, method="exact"), max(repeat // 5, 3)),
+        "serialize/json": timed(lambda i: json.dumps(result), repeat),
+        "serialize/float32": timed(lambda i: encode(result, COMPACT_JSON), repeat),
+    }
+
+
+def accuracy_benchmarks(repeat, counts=(2 ** 10, 2 ** 11, 2 ** 12, 2 ** 13, 2 ** 14, 2 ** 15), element_short="Ni",
+                        feedstock_type="peridotite", rate=25, reference_draws=2 ** 20):
+    """Relative RMS error of the p5/p50/p95 concentration for each sampler and draw count
+
+    The reference quantiles come from one scrambled Sobol run of reference_draws.
+    Counts are powers of two, so every sampler draws exactly that many points.
+    Returns {sampler: {draws: error}}.
+    """
+    import numpy as np
+
+    from heavy_metal_core import SAMPLERS, preset_input_ppfs, sample_conc_from_ppfs
+    from heavy_metal_random import RandomStreams
+
+    quantiles = [0.05, 0.5, 0.95]
+    ppfs = preset_input_ppfs(f"{element_short} (mg/kg)", feedstock_type)
+    reference = np.quantile(
+        sample_conc_from_ppfs(ppfs, rate, reference_draws, "sobol", RandomStreams(0).get("reference"))[2], quantiles
+    )
+    results = {}
+    for sampler in SAMPLERS:
+        results[sampler] = {}
+        for n in counts:
+            errors = np.array([
+                np.quantile(sample_conc_from_ppfs(ppfs, rate, n, sampler, RandomStreams(i).get(sampler))[2], quantiles)
+                / reference - 1
+                for i in range(repeat)
+            ])
+            results[sampler][n] = float(np.sqrt(np.mean(errors ** 2)))
+    return results
+
+
+def endpoint_benchmarks(client, repeat):
+    """Time uncached /calculate-preset requests for every element/feedstock pair"""
+    from heavy_metal_core import ELEMENTS
+
+    results = {}
+    for feedstock_type, elements in ELEMENTS.items():
+        for element_short in elements:
+            def request(i):
+                # A new seed per request bypasses the result cache
+                response = client.post("/calculate-preset", json={
+                    "element": element_short, "feedstock_type": feedstock_type, "seed": 1000 + i
+                })
+                if response.status_code != 200 or "error" in response.json():
+                    raise RuntimeError(response.text)
+            try:
+                results[f"preset/{element_short}/{feedstock_type}"] = timed(request, repeat)
+            except Exception as e:
+                print(f"skipping {element_short}/{feedstock_type}: {e}", file=sys.stderr)
+    return results
+
+
+def concurrent_benchmark(client, requests, concurrency, element_short="Ni", feedstock_type="basalt"):
+    """Send uncached preset requests from several threads at once"""
+    def request(seed):
+        start = time.perf_counter()
+        client.post("/calculate-preset", json={
+            "element": element_short, "feedstock_type": feedstock_type, "seed": 100000 + seed
+        })
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(request, range(requests)))
+    elapsed = time.perf_counter() - start
+    return {f"concurrent/{concurrency}": {**summarize(latencies), "throughput": requests / elapsed}}
+
+
+def compare(results, baseline, threshold):
+    """List (name, baseline_ms, current_ms, ratio) for benchmarks whose median regressed beyond threshold"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        ratio = current["median_ms"] / previous["median_ms"]
+        if ratio > 1 + threshold:
+            regressions.append((name, previous["median_ms"], current["median_ms"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="runs per benchmark")
+    parser.add_argument("--requests", type=int, default=50, help="requests in the concurrent scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", default="benchmarks/latest.json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="fail instead of skipping the comparison when the baseline is missing (for CI)")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed median slowdown as a fraction of the baseline (default: 0.2)")
+    parser.add_argument("--skip-endpoints", action="store_true", help="only run the stage benchmarks")
+    parser.add_argument("--skip-accuracy", action="store_true", help="skip the sampler accuracy benchmarks")
+    args = parser.parse_args()
+    if args.require_baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f"no baseline at {args.baseline}; record one with --save-baseline")
+
+    from fastapi.testclient import TestClient
+
+    import heavy_metal_api
+
+    results = stage_benchmarks(args.repeat)
+    if not args.skip_endpoints:
+        with TestClient(heavy_metal_api.app) as client:
+            results.update(endpoint_benchmarks(client, args.repeat))
+            results.update(concurrent_benchmark(client, args.requests, args.concurrency))
+    accuracy = {} if args.skip_accuracy else accuracy_benchmarks(args.repeat)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "workers": os.environ["HEAVY_METAL_WORKERS"],
+            "repeat": args.repeat,
+        },
+        "results": results,
+        "accuracy": accuracy,
+    }
+    for path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+    for name, summary in results.items():
+        print(f"{name:<32} median={summary['median_ms']:9.2f}ms  p95={summary['p95_ms']:9.2f}ms")
+    for sampler, errors in accuracy.items():
+        print(f"{'accuracy/' + sampler:<32} " + "  ".join(f"{n}: {error:.2%}" for n, error in errors.items()))
+
+    if args.save_baseline:
+        print(f"Saved baseline to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}: no regression comparison was made "
+              "(record one with --save-baseline, or pass --require-baseline to fail)")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for name, previous, current, ratio in regressions:
+        print(f"REGRESSION {name}: {previous:.2f}ms -> {current:.2f}ms ({ratio:.2f}x)")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
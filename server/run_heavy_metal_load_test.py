@@ -0,0 +1,106 @@
+"""Load test for /calculate-preset across worker pool sizes
+
+Starts the API once per worker count, sends concurrent uncached preset requests
+(a unique seed per request bypasses the result cache) and reports throughput.
+
+    python run_heavy_metal_load_test.py --workers 1,2,4,8 --requests 200 --concurrency 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def wait_until_healthy(url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/", timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.25)
+    raise RuntimeError(f"API at {url} did not become healthy within {timeout}s")
+
+
+def post_preset(url, element, feedstock_type, seed):
+    body = json.dumps({"element": element, "feedstock_type": feedstock_type, "seed": seed}).encode()
+    request = urllib.request.Request(
+        f"{url}/calculate-preset", data=body, headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def run_load(url, requests, concurrency, element, feedstock_type):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda seed: post_preset(url, element, feedstock_type, seed), range(requests)
+        ))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for status, latency in results if status == 200)
+    ok = len(latencies)
+    return {
+        "requests": requests,
+        "ok": ok,
+        "rejected": sum(1 for status, _ in results if status == 503),
+        "seconds": elapsed,
+        "throughput": ok / elapsed,
+        "p50_ms": 1000 * latencies[ok // 2] if ok else None,
+        "p95_ms": 1000 * latencies[int(ok * 0.95)] if ok else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4, os.cpu_count() or 1)),
+                        help="comma-separated worker pool sizes to test")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--element", default="Ni")
+    parser.add_argument("--feedstock-type", default="basalt")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    worker_counts = sorted({int(n) for n in args.workers.split(",")})
+    summary = []
+    for workers in worker_counts:
+        env = dict(os.environ, HEAVY_METAL_WORKERS=str(workers),
+                   HEAVY_METAL_QUEUE_SIZE=str(args.requests))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "heavy_metal_api:app", "--port", str(args.port),
+             "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            wait_until_healthy(url)
+            result = run_load(url, args.requests, args.concurrency, args.element, args.feedstock_type)
+        finally:
+            server.terminate()
+            server.wait()
+        result["workers"] = workers
+        summary.append(result)
+        # No latencies when every request was rejected
+        latency = (f"p50={result['p50_ms']:.0f}ms  p95={result['p95_ms']:.0f}ms" if result["ok"]
+                   else "p50=n/a  p95=n/a")
+        print(f"workers={workers:>3}  {result['throughput']:7.1f} req/s  {latency}  "
+              f"ok={result['ok']}/{result['requests']}")
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
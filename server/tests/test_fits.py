@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from heavy_metal_core import compute_preset
+from heavy_metal_fits import EMPIRICAL, FitError, fit_ppf, select_fit
+
+
+def test_one_value_column_is_rejected():
+    with pytest.raises(FitError):
+        select_fit([0.005])
+    with pytest.raises(FitError):
+        select_fit([0.005] * 50)
+
+
+def test_sparse_column_is_sampled_empirically():
+    fit = select_fit([0.005, 0.01])
+    assert fit["family"] == EMPIRICAL
+    assert np.ptp(fit_ppf({"family": EMPIRICAL, **fit}, np.linspace(0, 1, 11))) > 0
+
+
+@pytest.mark.parametrize("sampler", ["random", "lhs", "sobol"])
+def test_unfittable_preset_returns_an_error(sampler):
+    # The basalt data has a single Hg value
+    result = compute_preset("Hg", "basalt", seed=0, sampler=sampler)
+    assert set(result) == {"error"}
+    assert "Hg (mg/kg)" in result["error"]
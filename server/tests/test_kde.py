@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from heavy_metal_core import calculate_normalized_kde
+
+MAX_DEVIATION = 0.25  # Points on the 0-100 scale
+
+
+def samples(name, n=10000, seed=0):
+    rng = np.random.default_rng(seed)
+    if name == "normal":
+        return rng.normal(50, 10, n)
+    if name == "gamma":
+        return rng.gamma(2, 20, n)
+    return rng.lognormal(3, 1, n)  # Heavy-tailed
+
+
+@pytest.mark.parametrize("name", ["normal", "gamma", "lognormal"])
+def test_binned_matches_exact(name):
+    data = samples(name)
+    x_binned, y_binned = calculate_normalized_kde(data, method="binned")
+    x_exact, y_exact = calculate_normalized_kde(data, method="exact")
+
+    assert np.array_equal(x_binned, x_exact)
+    assert np.max(np.abs(np.array(y_binned) - np.array(y_exact))) < MAX_DEVIATION
+
+
+@pytest.mark.parametrize("method", ["binned", "exact"])
+def test_output_contract(method):
+    data = samples("gamma")
+    x, y = calculate_normalized_kde(data, num_points=200, method=method)
+
+    assert isinstance(x, list) and isinstance(y, list)
+    assert len(x) == len(y) == 200
+    assert x[0] == data.min() and x[-1] == data.max()
+    assert max(y) == 100
+    assert min(y) >= 0
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        calculate_normalized_kde(samples("normal"), method="histogram")
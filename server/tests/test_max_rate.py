@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from heavy_metal_core import calc_element_conc, compute_max_application_rates, max_application_rates
+
+N = 2000
+THRESHOLDS = [100.0, 200.0, 400.0]  # Above every baseline soil concentration
+
+
+def draws(seed=0):
+    rng = np.random.default_rng(seed)
+    soil_d = rng.uniform(1, 2, N)
+    feedstock_conc = rng.gamma(2, 50, N)
+    soil_conc = rng.gamma(3, 5, N)
+    dbd = rng.uniform(1, 1.7, N)
+    return soil_d, feedstock_conc, soil_conc, dbd
+
+
+def compliance(inputs, threshold, rate):
+    """Fraction of draws at or below the threshold at an application rate (up to rounding)"""
+    return np.mean(calc_element_conc(*inputs, rate) <= threshold * (1 + 1e-12))
+
+
+@pytest.mark.parametrize("quantile", [0.5, 0.95, 1])
+def test_rate_is_the_largest_compliant_rate(quantile):
+    inputs = draws()
+    rates = max_application_rates(*inputs, THRESHOLDS, quantile)
+    assert rates.shape == (len(THRESHOLDS),)
+    for threshold, rate in zip(THRESHOLDS, rates):
+        assert 0 < rate < np.inf
+        assert compliance(inputs, threshold, rate) >= quantile
+        assert compliance(inputs, threshold, rate * (1 + 1e-6)) < quantile
+
+
+def test_exceeded_without_application():
+    soil_d, feedstock_conc, soil_conc, dbd = draws()
+    # Below every baseline soil concentration, and below 10% of them (too many for quantile 0.95)
+    threshold = np.quantile(soil_conc, 0.9)
+    rates = max_application_rates(soil_d, feedstock_conc, soil_conc, dbd, [soil_conc.min() / 2, threshold])
+    assert np.all(rates == -np.inf)
+    assert max_application_rates(soil_d, feedstock_conc, soil_conc, dbd, [threshold], quantile=0.85)[0] > 0
+
+
+def test_unbounded_without_feedstock_metal():
+    soil_d, feedstock_conc, soil_conc, dbd = draws()
+    rates = max_application_rates(soil_d, np.zeros(N), soil_conc, dbd, [soil_conc.max() + 1])
+    assert rates[0] == np.inf
+
+
+def test_statuses_are_reported_without_infinities():
+    result = compute_max_application_rates("Ni", "basalt", [0.0, 1e6], seed=0)
+    assert result["status"] == ["exceeded", "ok"]
+    assert result["max_application_rates"][0] is None
+    assert result["max_application_rates"][1] > 0
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from heavy_metal_random import RandomStreams
+
+
+def test_streams_depend_only_on_seed_and_key():
+    a, b = RandomStreams(5), RandomStreams(5)
+    assert np.array_equal(a.get("rate", 2).random(10), b.get("rate", 2).random(10))
+    assert not np.array_equal(a.get("rate", 2).random(10), a.get("rate", 3).random(10))
+
+
+def test_generated_seed_is_echoed():
+    streams = RandomStreams()
+    assert np.array_equal(streams.get("soil").random(5), RandomStreams(streams.seed).get("soil").random(5))
+
+
+def test_negative_seed_is_rejected():
+    with pytest.raises(ValueError):
+        RandomStreams(-1)
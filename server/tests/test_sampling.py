@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from heavy_metal_core import calc_element_conc, calc_element_conc_dist, sample_element_conc, uniform_points
+from heavy_metal_random import RandomStreams
+
+N = 2000
+
+
+def input_dists(seed=0):
+    rng = np.random.default_rng(seed)
+    dbd_dist = rng.uniform(800, 1700, 1000)
+    soil_d_dist = rng.uniform(0.2, 3, 5000)  # Straddles 1, so the clamp applies to some draws
+    feedstock_dist = rng.gamma(2, 50, 5000)
+    soil_dist = rng.gamma(3, 10, 5000)
+    return dbd_dist, soil_d_dist, feedstock_dist, soil_dist
+
+
+def loop_element_conc_dist(t, dbd_dist, soil_d_dist, feedstock_dist, soil_dist, indices):
+    """The original per-draw loop, with each rng.choice replaced by the replayed index"""
+    soil_d_idx, feedstock_idx, soil_idx, dbd_idx = indices
+    return np.array([
+        calc_element_conc(
+            max(soil_d_dist[soil_d_idx[i]], 1),  # Ensure soil_d >= 1
+            feedstock_dist[feedstock_idx[i]],
+            soil_dist[soil_idx[i]],
+            dbd_dist[dbd_idx[i]],
+            t
+        )
+        for i in range(len(soil_d_idx))
+    ])
+
+
+def replay_indices(rng, dbd_dist, soil_d_dist, feedstock_dist, soil_dist, n):
+    """Draw the indices in the order resample_inputs does: soil_d, feedstock, soil, dbd"""
+    return [rng.integers(0, len(dist), size=(1, n))[0] for dist in (soil_d_dist, feedstock_dist, soil_dist, dbd_dist)]
+
+
+def test_vectorized_matches_loop():
+    dists = input_dists()
+    for t in (0, 5, 25, 125):
+        expected = loop_element_conc_dist(t, *dists, replay_indices(np.random.default_rng(42), *dists, N))
+        actual = calc_element_conc_dist(t, *dists, n=N, rng=np.random.default_rng(42))
+        assert np.array_equal(actual, expected)
+
+
+def test_soil_depth_is_clamped():
+    dbd_dist, _, feedstock_dist, soil_dist = input_dists()
+    shallow = np.full(10, 0.1)
+    actual = calc_element_conc_dist(50, dbd_dist, shallow, feedstock_dist, soil_dist, n=N, rng=1)
+    at_one = calc_element_conc_dist(50, dbd_dist, np.ones(10), feedstock_dist, soil_dist, n=N, rng=1)
+    assert np.array_equal(actual, at_one)
+
+
+def test_rates_match_separate_streams():
+    dists = input_dists()
+    rates = [0, 25, 50, 75]
+    streams = RandomStreams(7)
+    together = sample_element_conc(rates, *dists, n=N, rng=streams)
+    for i, t in enumerate(rates):
+        indices = replay_indices(streams.get("rate", i), *dists, N)
+        assert np.array_equal(together[i], loop_element_conc_dist(t, *dists, indices))
+
+
+@pytest.mark.parametrize("sampler, n, rows", [("random", 10000, 10000), ("lhs", 10000, 10000), ("sobol", 10000, 16384),
+                                               ("sobol", 1024, 1024)])
+def test_sobol_points_are_whole_powers_of_two(sampler, n, rows):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")  # scipy warns when Sobol points lose their balance
+        u = uniform_points(sampler, n, 4, rng=0)
+    assert u.shape == (rows, 4)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from heavy_metal_sensitivity import sobol_indices
+
+
+def uniform(u):
+    return u
+
+
+def uniform_pi(u):
+    """Uniform on [-pi, pi], the Ishigami input range"""
+    return np.pi * (2 * u - 1)
+
+
+def linear(x):
+    return x[..., 0] + 2 * x[..., 1]
+
+
+def ishigami(x, a=7, b=0.1):
+    return np.sin(x[..., 0]) + a * np.sin(x[..., 1]) ** 2 + b * x[..., 2] ** 4 * np.sin(x[..., 0])
+
+
+def test_additive_model_indices():
+    # Var(x1) : Var(2 x2) = 1 : 4 with x uniform on [0, 1]; x3 has no effect
+    first_order, total, _, _, n = sobol_indices([uniform] * 3, linear, 4096, rng=0, bootstrap=0)
+    assert n == 4096
+    np.testing.assert_allclose(first_order, [0.2, 0.8, 0], atol=0.01)
+    np.testing.assert_allclose(total, [0.2, 0.8, 0], atol=0.01)
+
+
+def test_ishigami_indices():
+    first_order, total, _, _, _ = sobol_indices([uniform_pi] * 3, ishigami, 2 ** 14, rng=0, bootstrap=0)
+    np.testing.assert_allclose(first_order, [0.3139, 0.4424, 0], atol=0.02)
+    np.testing.assert_allclose(total, [0.5576, 0.4424, 0.2437], atol=0.02)
+
+
+def test_bootstrap_intervals():
+    first_order, total, first_order_ci, total_ci, n = sobol_indices(
+        [uniform_pi] * 3, ishigami, 3000, rng=0, bootstrap=100, bootstrap_rng=0
+    )
+    assert n == 4096  # Rounded up to a power of two
+    assert first_order_ci.shape == total_ci.shape == (3, 2)
+    assert np.all(first_order_ci[:, 0] <= first_order_ci[:, 1])
+    assert np.all(total_ci[:, 0] <= total_ci[:, 1])
+    # The point estimates lie inside their 95% intervals
+    assert np.all((first_order_ci[:, 0] <= first_order) & (first_order <= first_order_ci[:, 1]))
+    assert np.all((total_ci[:, 0] <= total) & (total <= total_ci[:, 1]))
+
+
+def test_constant_model_is_rejected():
+    with pytest.raises(ValueError):
+        sobol_indices([uniform] * 2, lambda x: np.zeros(x.shape[:-1]), 256, rng=0, bootstrap=0)